@@ -0,0 +1,51 @@
+"""
+Inline button callback_data parsing for the Telegram bot.
+
+Pure, fully annotated functions with no bot or I/O dependencies, so the
+module can optionally be compiled with mypyc (`mypyc callback_parse.py`);
+the bot imports the compiled extension when present and this source otherwise.
+
+Callback formats:
+- download_<filename> or download_<8-char hash>
+- reverify_qr_<8-char hash>
+- reverify_manual_<fn>_<fd>_<fp>_<t>_<n>_<s>
+"""
+
+import re
+from typing import Optional, Tuple
+
+DOWNLOAD_PREFIX = 'download_'
+REVERIFY_QR_PREFIX = 'reverify_qr_'
+REVERIFY_MANUAL_PREFIX = 'reverify_manual_'
+
+# Length of hex hashes used when a value doesn't fit in 64-byte callback_data
+HASH_LENGTH = 8
+
+_REVERIFY_MANUAL_RE = re.compile(r'reverify_manual_([^_]+)_([^_]+)_([^_]+)_([^_]+)_([^_]+)_(.+)')
+
+
+def parse_download_callback(data: str) -> str:
+    """Return the filename or hash from download callback data."""
+    if data.startswith(DOWNLOAD_PREFIX):
+        return data[len(DOWNLOAD_PREFIX):]
+    return data
+
+
+def is_short_hash(identifier: str) -> bool:
+    """Check if identifier looks like a callback hash rather than a filename."""
+    return len(identifier) == HASH_LENGTH
+
+
+def parse_reverify_qr(data: str) -> Optional[str]:
+    """Return the QR string hash from reverify_qr callback data, or None."""
+    if data.startswith(REVERIFY_QR_PREFIX):
+        return data[len(REVERIFY_QR_PREFIX):]
+    return None
+
+
+def parse_reverify_manual(data: str) -> Optional[Tuple[str, str, str, str, str, str]]:
+    """Return (fn, fd, fp, t, n, s) from reverify_manual callback data, or None if malformed."""
+    m = _REVERIFY_MANUAL_RE.match(data)
+    if m is None:
+        return None
+    return m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6)
@@ -1,15 +1,35 @@
 import os
+import sys
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import csv
+import io
 import time
-import hashlib
 import logging
-from typing import Dict, Optional, List, Union, Tuple
+from array import array
+from collections import OrderedDict
+from itertools import repeat
+from operator import truediv
+from types import MappingProxyType
+from urllib.parse import parse_qsl, urlencode
+from typing import Dict, Hashable, Iterable, Iterator, Mapping, Optional, List, Set, Union, Tuple
 from datetime import datetime
 from dataclasses import dataclass, field
 from pathlib import Path
 
+try:
+    import orjson  # Optional: faster JSON parsing/serialization
+except ImportError:
+    orjson = None
+
+try:
+    import aiohttp  # Optional: required only by AsyncReceiptVerifier
+except ImportError:
+    aiohttp = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -17,7 +37,64 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+# __slots__ for data objects where supported (dataclass(slots=True) needs Python 3.10+)
+_DATACLASS_OPTIONS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+# Known API error codes (read-only)
+_ERROR_MESSAGES: Mapping[int, str] = MappingProxyType({
+    0: "Invalid receipt",
+    2: "Receipt data not yet available",
+    3: "Request limit exceeded",
+    4: "Wait before retrying",
+    5: "Data not received"
+})
+
+# Headers for pre-encoded form bodies
+_FORM_HEADERS: Dict[str, str] = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+# API codes that will not change on retry; such results are negatively cached
+_PERMANENT_ERROR_CODES = frozenset({0, 5})
+
+# Receipt directories already created by to_csv in this process
+_created_dirs: Set[str] = set()
+
+# Receipt money fields and matching API keys (API amounts are in kopeks)
+_KOPEK_FIELDS: Tuple[str, ...] = (
+    'total_sum', 'cash_sum', 'card_sum', 'vat_20', 'vat_10', 'vat_0', 'vat_none'
+)
+_KOPEK_KEYS: Tuple[str, ...] = (
+    'totalSum', 'cashTotalSum', 'ecashTotalSum', 'nds18', 'nds', 'nds0', 'ndsNo'
+)
+
+
+def _kopeks_to_rubles(kopeks: Iterable[Union[int, float]]) -> Iterator[float]:
+    """Convert kopek amounts to rubles in one C-level map (no per-item bytecode)"""
+    return map(truediv, kopeks, repeat(100))
+
+
+def json_loads(data: bytes) -> Dict:
+    """Decode JSON bytes, using orjson when available (shared with the Telegram bot)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _write_text(filename: str, text: str) -> None:
+    """Write UTF-8 text with a large buffer, newlines untranslated (csv.writer already emits them)"""
+    with open(filename, 'w', buffering=1 << 16, newline='', encoding='utf-8') as f:
+        f.write(text)
+
+
+def json_dumps(data: Dict, indent: bool = False) -> bytes:
+    """Encode JSON as UTF-8 bytes (compact, or 2-space indent), using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+@dataclass(**_DATACLASS_OPTIONS)
 class ReceiptItem:
     """Single item in receipt"""
     name: str
@@ -26,7 +103,53 @@ class ReceiptItem:
     sum: float  # in rubles
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
+class ReceiptItems:
+    """
+    Receipt items stored column-wise (structure of arrays).
+
+    Money columns are contiguous float64 arrays; quantities keep the values
+    returned by the API as-is. Iterating or indexing yields ReceiptItem rows,
+    slicing yields a new ReceiptItems.
+    """
+    names: List[str] = field(default_factory=list)
+    prices: array = field(default_factory=lambda: array('d'))  # in rubles
+    quantities: List[float] = field(default_factory=list)
+    sums: array = field(default_factory=lambda: array('d'))  # in rubles
+
+    @classmethod
+    def from_api_items(cls, raw_items: List[Dict]) -> 'ReceiptItems':
+        """Build item columns from API 'items' list (prices in kopeks)"""
+        return cls(
+            names=[item.get('name', '') for item in raw_items],
+            prices=array('d', _kopeks_to_rubles([item.get('price', 0) for item in raw_items])),
+            quantities=[item.get('quantity', 0) for item in raw_items],
+            sums=array('d', _kopeks_to_rubles([item.get('sum', 0) for item in raw_items]))
+        )
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[ReceiptItem]:
+        return map(ReceiptItem, self.names, self.prices, self.quantities, self.sums)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[ReceiptItem, 'ReceiptItems']:
+        if isinstance(index, slice):
+            return ReceiptItems(
+                names=self.names[index],
+                prices=self.prices[index],
+                quantities=self.quantities[index],
+                sums=self.sums[index]
+            )
+        return ReceiptItem(
+            name=self.names[index],
+            price=self.prices[index],
+            quantity=self.quantities[index],
+            sum=self.sums[index]
+        )
+
+
+@dataclass(**_DATACLASS_OPTIONS)
 class Receipt:
     """Receipt data object"""
     # Status
@@ -43,6 +166,7 @@ class Receipt:
     # Receipt info
     date: str = ""
     time: str = ""
+    time_fs: str = ""  # filename-safe time (HH-MM-SS)
     place: str = ""
     cashier: str = ""
     receipt_number: str = ""
@@ -55,7 +179,7 @@ class Receipt:
     operation_type: int = 0
 
     # Items
-    items: List[ReceiptItem] = field(default_factory=list)
+    items: ReceiptItems = field(default_factory=ReceiptItems)
 
     # Totals
     total_sum: float = 0.0  # in rubles
@@ -73,54 +197,38 @@ class Receipt:
     html_content: str = ""
 
     @classmethod
-    def from_api_response(cls, response: Dict) -> 'Receipt':
-        """Create Receipt object from API response"""
-        code = response.get('code', -1)
-
-        # Handle error codes
-        error_messages = {
-            0: "Invalid receipt",
-            2: "Receipt data not yet available",
-            3: "Request limit exceeded",
-            4: "Wait before retrying",
-            5: "Data not received"
-        }
+    def from_api_response(cls, response: Dict, keep_raw: bool = False) -> 'Receipt':
+        """
+        Create Receipt object from API response.
 
-        if code in error_messages:
-            return cls(
-                code=code,
-                is_valid=False,
-                error_message=error_messages[code],
-                date_time=datetime.now()
-            )
-        elif code != 1:
-            error = response.get('error', 'Unknown error')
-            return cls(
-                code=code,
-                is_valid=False,
-                error_message=error,
-                date_time=datetime.now()
-            )
+        The response dict is kept in raw_response only with keep_raw=True
+        (needed by save_json); otherwise it is released after parsing.
+        """
+        code = response.get('code', -1)
+        if code != 1:
+            return cls._from_error(code, response)
 
         # Parse successful response
         data = response.get('data', {}).get('json', {})
 
-        # Parse date
+        # Parse date: 'YYYY-MM-DDTHH:MM:SS' is sliced directly, other forms are parsed
         date_str = data.get('dateTime', '')
-        try:
-            date_time = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S') if date_str else None
-        except ValueError:
-            date_time = None
+        if len(date_str) >= 19 and date_str[10] == 'T':
+            date, time = date_str[:10], date_str[11:19]
+            time_fs = f"{date_str[11:13]}-{date_str[14:16]}-{date_str[17:19]}"
+        else:
+            try:
+                date_time = datetime.fromisoformat(date_str)
+                date, time = date_time.strftime('%Y-%m-%d'), date_time.strftime('%H:%M:%S')
+                time_fs = date_time.strftime('%H-%M-%S')
+            except ValueError:
+                date, time, time_fs = "", "", ""
 
         # Parse items
-        items = []
-        for item_data in data.get('items', []):
-            items.append(ReceiptItem(
-                name=item_data.get('name', ''),
-                price=item_data.get('price', 0) / 100,
-                quantity=item_data.get('quantity', 0),
-                sum=item_data.get('sum', 0) / 100
-            ))
+        items = ReceiptItems.from_api_items(data.get('items', []))
+
+        # Convert all money totals at once
+        amounts = dict(zip(_KOPEK_FIELDS, _kopeks_to_rubles(map(data.get, _KOPEK_KEYS, repeat(0)))))
 
         return cls(
             code=code,
@@ -128,8 +236,9 @@ class Receipt:
             organization=data.get('user', ''),
             address=data.get('retailPlaceAddress', ''),
             inn=data.get('userInn', ''),
-            time=date_time.strftime('%H:%M:%S'),
-            date=date_time.strftime('%Y-%m-%d'),
+            time=time,
+            time_fs=time_fs,
+            date=date,
             place=data.get('retailPlace', ''),
             cashier=data.get('operator', ''),
             receipt_number=data.get('requestNumber', ''),
@@ -139,15 +248,22 @@ class Receipt:
             fiscal_sign=data.get('fiscalSign', ''),
             operation_type=data.get('operationType', 0),
             items=items,
-            total_sum=data.get('totalSum', 0) / 100,
-            cash_sum=data.get('cashTotalSum', 0) / 100,
-            card_sum=data.get('ecashTotalSum', 0) / 100,
-            vat_20=data.get('nds18', 0) / 100,
-            vat_10=data.get('nds', 0) / 100,
-            vat_0=data.get('nds0', 0) / 100,
-            vat_none=data.get('ndsNo', 0) / 100,
+            **amounts,
             html_content=response.get('data', {}).get('html', ''),
-            raw_response=response
+            raw_response=response if keep_raw else {}
+        )
+
+    @classmethod
+    def _from_error(cls, code: int, response: Dict) -> 'Receipt':
+        """Create invalid Receipt for an API error code"""
+        error_message = _ERROR_MESSAGES.get(code)
+        if error_message is None:
+            error_message = response.get('error', 'Unknown error')
+        return cls(
+            code=code,
+            is_valid=False,
+            error_message=error_message,
+            date_time=datetime.now()
         )
 
     def to_text(self) -> str:
@@ -155,75 +271,99 @@ class Receipt:
         if not self.is_valid:
             return f"❌ {self.error_message}"
 
-        result = f"✅ Receipt verified\n\n"
-        result += f"Organization: {self.organization}\n"
-        result += f"Address: {self.address}\n"
-        result += f"INN: {self.inn}\n"
-        result += f"Date: {self.date}\n"
-        result += f"Total: {self.total_sum:.2f} ₽\n"
-        result += f"Cash: {self.cash_sum:.2f} ₽\n"
-        result += f"Card: {self.card_sum:.2f} ₽\n\n"
-
-        if self.items:
-            result += "Items:\n"
-            for item in self.items:
-                result += f"  • {item.name} - {item.price:.2f} ₽ x {item.quantity}\n"
+        parts = [
+            "✅ Receipt verified\n\n",
+            f"Organization: {self.organization}\n",
+            f"Address: {self.address}\n",
+            f"INN: {self.inn}\n",
+            f"Date: {self.date}\n",
+            f"Total: {self.total_sum:.2f} ₽\n",
+            f"Cash: {self.cash_sum:.2f} ₽\n",
+            f"Card: {self.card_sum:.2f} ₽\n\n"
+        ]
+
+        items = self.items
+        if items:
+            parts.append("Items:\n")
+            parts.extend(
+                f"  • {name} - {price:.2f} ₽ x {quantity}\n"
+                for name, price, quantity in zip(items.names, items.prices, items.quantities)
+            )
 
-        return result
+        return "".join(parts)
 
     def to_csv(self, filename: Optional[str] = None, receipts_dir: str = "receipts") -> Optional[str]:
         """Save receipt to CSV file"""
         if not self.is_valid:
             return None
         
-        # Create receipts directory if it doesn't exist
-        Path(receipts_dir).mkdir(exist_ok=True)
+        # Create receipts directory once per process
+        if receipts_dir not in _created_dirs:
+            Path(receipts_dir).mkdir(exist_ok=True)
+            _created_dirs.add(receipts_dir)
 
         # Generate filename if not provided
         if filename is None:
-            filename = f"{self.date}_{self.time.replace(':', '-')}_{self.fiscal_drive_number}_{self.fiscal_document_number}_{self.fiscal_sign}.csv"
+            time_fs = self.time_fs or self.time.replace(':', '-')
+            filename = f"{self.date}_{time_fs}_{self.fiscal_drive_number}_{self.fiscal_document_number}_{self.fiscal_sign}.csv"
             filename = os.path.join(receipts_dir, filename)
 
+        items = self.items
+        rows = [
+            # Header info
+            ['Receipt Information'],
+            ['Organization', self.organization],
+            ['Place', self.place],
+            ['Address', self.address],
+            ['INN', self.inn],
+            ['Date', self.date],
+            ['Time', self.time],
+            ['Cashier', self.cashier],
+            ['Receipt Number', self.receipt_number],
+            ['Shift', self.shift_number],
+            ['Fiscal Drive Number', self.fiscal_drive_number],
+            ['Fiscal Document Number', self.fiscal_document_number],
+            ['Fiscal Sign', self.fiscal_sign],
+            [],
+
+            # Items
+            ['Item Name', 'Price (₽)', 'Quantity', 'Sum (₽)'],
+            *zip(
+                items.names,
+                map('{:.2f}'.format, items.prices),
+                items.quantities,
+                map('{:.2f}'.format, items.sums)
+            ),
+            [],
+
+            # Totals
+            ['Payment Method', 'Amount (₽)'],
+            ['Cash', f"{self.cash_sum:.2f}"],
+            ['Card', f"{self.card_sum:.2f}"],
+            ['TOTAL', f"{self.total_sum:.2f}"],
+
+            # VAT
+            [],
+            ['VAT Information'],
+            ['VAT 20%', f"{self.vat_20:.2f}"],
+            ['VAT 10%', f"{self.vat_10:.2f}"],
+            ['VAT 0%', f"{self.vat_0:.2f}"],
+            ['No VAT', f"{self.vat_none:.2f}"],
+        ]
+
+        # Render the whole file in memory (csv.writer still handles quoting)
+        buffer = io.StringIO(newline='')
+        csv.writer(buffer).writerows(rows)
+
         try:
-            with open(filename, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-
-                # Header info
-                writer.writerow(['Receipt Information'])
-                writer.writerow(['Organization', self.organization])
-                writer.writerow(['Place', self.place])                
-                writer.writerow(['Address', self.address])
-                writer.writerow(['INN', self.inn])
-                writer.writerow(['Date', self.date])
-                writer.writerow(['Time', self.time])
-                writer.writerow(['Cashier', self.cashier])
-                writer.writerow(['Receipt Number', self.receipt_number])
-                writer.writerow(['Shift', self.shift_number])
-                writer.writerow(['Fiscal Drive Number', self.fiscal_drive_number])
-                writer.writerow(['Fiscal Document Number', self.fiscal_document_number])
-                writer.writerow(['Fiscal Sign', self.fiscal_sign])
-                writer.writerow([])
-
-                # Items
-                writer.writerow(['Item Name', 'Price (₽)', 'Quantity', 'Sum (₽)'])
-                for item in self.items:
-                    writer.writerow([item.name, f"{item.price:.2f}", item.quantity, f"{item.sum:.2f}"])
-
-                writer.writerow([])
-
-                # Totals
-                writer.writerow(['Payment Method', 'Amount (₽)'])
-                writer.writerow(['Cash', f"{self.cash_sum:.2f}"])
-                writer.writerow(['Card', f"{self.card_sum:.2f}"])
-                writer.writerow(['TOTAL', f"{self.total_sum:.2f}"])
-
-                # VAT
-                writer.writerow([])
-                writer.writerow(['VAT Information'])
-                writer.writerow(['VAT 20%', f"{self.vat_20:.2f}"])
-                writer.writerow(['VAT 10%', f"{self.vat_10:.2f}"])
-                writer.writerow(['VAT 0%', f"{self.vat_0:.2f}"])
-                writer.writerow(['No VAT', f"{self.vat_none:.2f}"])
+            try:
+                _write_text(filename, buffer.getvalue())
+            except FileNotFoundError:
+                # Directory was removed after it was created; create it again and retry once
+                _created_dirs.discard(receipts_dir)
+                Path(receipts_dir).mkdir(exist_ok=True)
+                _created_dirs.add(receipts_dir)
+                _write_text(filename, buffer.getvalue())
 
             return filename
 
@@ -232,7 +372,7 @@ class Receipt:
             return None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class RequestParams:
     """Structured request parameters with validation"""
     fn: str  # Fiscal drive number
@@ -255,10 +395,12 @@ class RequestParams:
             'qr': self.qr
         }
 
-    def fingerprint(self) -> str:
-        """Generate unique fingerprint for caching"""
-        key = f"{self.fn}_{self.fd}_{self.fp}_{self.t}"
-        return hashlib.md5(key.encode()).hexdigest()
+    def fingerprint(self) -> Tuple[str, str, str, str, str, str]:
+        """
+        Generate unique fingerprint for caching (used directly as dict key).
+        Includes type and sum so a mistyped n or s is sent to the API, not served from cache.
+        """
+        return self.fn, self.fd, self.fp, self.t, self.n, self.s
 
 
 class RequestBuilder:
@@ -280,6 +422,25 @@ class RequestBuilder:
         """
         return {'qrraw': qr_string}
 
+    @staticmethod
+    def parse_qr_string(qr_string: str) -> Optional[RequestParams]:
+        """
+        Parse QR code string locally into RequestParams ('i' is the fiscal document number).
+        Returns None if any required field is missing.
+        """
+        fields = dict(parse_qsl(qr_string))
+        try:
+            return RequestParams(
+                fn=fields['fn'],
+                fd=fields['i'],
+                fp=fields['fp'],
+                t=fields['t'],
+                n=fields['n'],
+                s=fields['s']
+            )
+        except KeyError:
+            return None
+
     @staticmethod
     def from_qr_url(url: str) -> Dict[str, str]:
         """Create request from QR image URL"""
@@ -311,51 +472,64 @@ class RetryHandler:
         self.max_retries = max_retries
         self.base_delay = base_delay
 
+        # Delay tables indexed by attempt number
+        self._delays_exponential = tuple(base_delay * (1 << attempt) for attempt in range(max_retries))
+        self._delays_progressive = tuple(base_delay * (1.5 ** attempt) for attempt in range(max_retries))
+        self._delay_wait = base_delay * 2
+
     def should_retry(self, code: int) -> bool:
         """Determine if error code warrants retry"""
         return code in [2, 3, 4]  # Not ready, rate limit, wait
 
     def get_delay(self, code: int, attempt: int) -> float:
         """
-        Calculate delay based on error code and attempt number.
+        Look up delay based on error code and attempt number.
         Uses exponential backoff: delay = base_delay * 2^attempt
         """
         if code == 3:  # Rate limit exceeded
-            return self.base_delay * (2 ** attempt)
+            return self._delays_exponential[attempt]
         elif code == 4:  # Wait before retry
-            return self.base_delay * 2
+            return self._delay_wait
         elif code == 2:  # Data not ready yet
-            return self.base_delay * (1.5 ** attempt)
+            return self._delays_progressive[attempt]
         return self.base_delay
 
+    def get_network_delay(self, attempt: int) -> float:
+        """Delay after a network error: base_delay * 2^attempt"""
+        return self._delays_exponential[attempt]
+
 
 class ReceiptCache:
     """
-    LRU-style cache for receipt data to avoid redundant API calls.
-    Uses receipt fingerprint as cache key for O(1) lookups.
+    LRU cache for receipt data to avoid redundant API calls.
+    Uses receipt fingerprint as cache key for O(1) lookups;
+    entries are reordered on access so hot receipts are never evicted first.
     """
 
     def __init__(self, max_size: int = 1000):
-        self.cache: Dict[str, Receipt] = {}
+        self.cache: 'OrderedDict[Hashable, Receipt]' = OrderedDict()
         self.max_size = max_size
         self.hits = 0
         self.misses = 0
 
-    def get(self, key: str) -> Optional[Receipt]:
+    def get(self, key: Hashable) -> Optional[Receipt]:
         """Retrieve cached receipt"""
-        if key in self.cache:
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
             self.hits += 1
             logger.debug(f"Cache hit for {key}")
-            return self.cache[key]
+            return cached
         self.misses += 1
         return None
 
-    def put(self, key: str, _receipt: Receipt):
+    def put(self, key: Hashable, _receipt: Receipt):
         """Store receipt in cache with LRU eviction"""
-        if len(self.cache) >= self.max_size:
-            # Simple LRU: remove oldest item
-            oldest_key = next(iter(self.cache))
-            del self.cache[oldest_key]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        elif len(self.cache) >= self.max_size:
+            # Evict least recently used item
+            self.cache.popitem(last=False)
         self.cache[key] = _receipt
 
     def stats(self) -> Dict[str, Union[int, str]]:
@@ -383,21 +557,53 @@ class ReceiptVerifier:
     Features:
     - Automatic retry with exponential backoff
     - Receipt caching to minimize API calls
+    - Negative caching of permanently invalid receipts
     - Support for all 4 API request formats
+    - Persistent HTTP session with connection pooling
     - Optional promo_id and custom userdata parameters
+    - HTML receipt rendering dropped unless keep_html=True (saves memory)
+    - Raw API response kept on receipts only with keep_raw=True (for save_json)
     """
-    def __init__(self, token: str, max_retries: int = 3, cache_size: int = 1000):
+    def __init__(
+            self,
+            token: str,
+            max_retries: int = 3,
+            cache_size: int = 1000,
+            keep_html: bool = False,
+            keep_raw: bool = False
+    ):
         self.token = token
+        self.keep_html = keep_html
+        self.keep_raw = keep_raw
         self.api_url = 'https://proverkacheka.com/api/v1/check/get'
         self.retry_handler = RetryHandler(max_retries=max_retries)
         self.cache = ReceiptCache(max_size=cache_size)
+        # Known-bad requests (codes 0/5) to avoid re-querying the API; keyed by the
+        # full request (incl. sum and type) so a typo doesn't mask the receipt
+        self.negative_cache = ReceiptCache(max_size=cache_size)
+
+        # Pooled keep-alive session. HTTP-level throttling (429/503) is retried
+        # by urllib3 inside the transport; API body codes 2/3/4 by RetryHandler.
+        transport_retry = Retry(
+            total=max_retries,
+            connect=0,
+            read=0,
+            status=max_retries,
+            backoff_factor=self.retry_handler.base_delay,
+            status_forcelist=(429, 503),
+            allowed_methods=frozenset({'POST'}),
+            respect_retry_after_header=True
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=transport_retry))
 
     def verify_receipt(
             self,
             request_data: Union[Dict[str, str], RequestParams],
             files: Optional[Dict] = None,
             promo_id: Optional[int] = None,
-            userdata: Optional[Dict[str, str]] = None
+            userdata: Optional[Dict[str, str]] = None,
+            use_cache: bool = True
     ) -> Receipt:
         """
         Verify receipt with automatic retry logic.
@@ -407,71 +613,51 @@ class ReceiptVerifier:
             files: Optional file dict for qrfile format
             promo_id: Optional promo campaign ID
             userdata: Optional custom parameters (userdata_<key>=value)
+            use_cache: Look up cached results first (False forces an API call; the result is still cached)
 
         Returns:
             Receipt object with verification result
         """
-        # Convert RequestParams to dict if needed
-        if isinstance(request_data, RequestParams):
-            request_dict = request_data.to_dict()
-            cache_key = request_data.fingerprint()
-        else:
-            request_dict = request_data.copy()
-            # Generate cache key for qrraw format
-            cache_key = None
-            if 'qrraw' in request_dict:
-                cache_key = hashlib.md5(request_dict['qrraw'].encode()).hexdigest()
+        cache_key, request_dict = self._prepare_request(request_data, promo_id, userdata)
 
         # Check cache
-        if cache_key:
-            cached = self.cache.get(cache_key)
+        if use_cache:
+            cached = self._lookup_cache(cache_key, request_dict)
             if cached:
                 return cached
 
-        # Add token
-        request_dict['token'] = self.token
-
-        # Add optional parameters
-        if promo_id:
-            request_dict['promo_id'] = str(promo_id)
-
-        if userdata:
-            for key, value in userdata.items():
-                request_dict[f'userdata_{key}'] = value
+        # Encode the form body once for all attempts (multipart uploads are built by requests)
+        if files:
+            body, headers = request_dict, None
+        else:
+            body, headers = urlencode(request_dict), _FORM_HEADERS
 
         # Retry loop with exponential backoff
         for attempt in range(self.retry_handler.max_retries):
             try:
-                response = requests.post(self.api_url, data=request_dict, files=files)
+                response = self.session.post(self.api_url, data=body, headers=headers, files=files)
                 response.raise_for_status()
-                result = response.json()
-
-                code = result.get('code', -1)
+                result = self._decode_response(response.content)
 
-                # Success case
-                if code == 1:
-                    formed_receipt = Receipt.from_api_response(result)
-                    # Store receipt in cache with cache key
-                    if cache_key and formed_receipt.is_valid:
-                        self.cache.put(cache_key, formed_receipt)
+                formed_receipt, delay = self._handle_result(result, cache_key, request_dict, attempt)
+                if formed_receipt is not None:
                     return formed_receipt
-
-                # Retry case
-                if self.retry_handler.should_retry(code):
-                    if attempt < self.retry_handler.max_retries - 1:
-                        delay = self.retry_handler.get_delay(code, attempt)
-                        logger.info(
-                            f"Code {code} received, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.retry_handler.max_retries})")
-                        time.sleep(delay)
-                        continue
-
-                # Non-retryable error
-                return Receipt.from_api_response(result)
-
-            except requests.exceptions.RequestException as e:
+                time.sleep(delay)
+
+            except requests.exceptions.RetryError as e:
+                # Transport already retried throttled responses with backoff
+                logger.error(f"Request failed after HTTP retries: {e}")
+                return Receipt(
+                    code=-1,
+                    is_valid=False,
+                    error_message=f"Network error: {str(e)}",
+                    date_time=datetime.now()
+                )
+
+            except (requests.exceptions.RequestException, ValueError) as e:
                 logger.error(f"Request failed: {e}")
                 if attempt < self.retry_handler.max_retries - 1:
-                    delay = self.retry_handler.base_delay * (2 ** attempt)
+                    delay = self.retry_handler.get_network_delay(attempt)
                     logger.info(f"Network error, retrying in {delay:.2f}s")
                     time.sleep(delay)
                 else:
@@ -495,23 +681,279 @@ class ReceiptVerifier:
             date_time=datetime.now()
         )
 
+    def _prepare_request(
+            self,
+            request_data: Union[Dict[str, str], RequestParams],
+            promo_id: Optional[int] = None,
+            userdata: Optional[Dict[str, str]] = None
+    ) -> Tuple[Optional[Hashable], Dict[str, str]]:
+        """Build API form fields and the cache key (None if not cacheable)"""
+        if isinstance(request_data, RequestParams):
+            cache_key = request_data.fingerprint()
+            base = request_data.to_dict()
+        else:
+            cache_key = self._dict_cache_key(request_data)
+            base = request_data
+
+        # Token and optional parameters merged in a single dict build (caller's dict is never mutated)
+        request_dict = {
+            **base,
+            'token': self.token,
+            **({'promo_id': str(promo_id)} if promo_id else {}),
+            **{f'userdata_{key}': value for key, value in (userdata or {}).items()}
+        }
+
+        return cache_key, request_dict
+
+    @staticmethod
+    def _dict_cache_key(request_data: Dict[str, str]) -> Optional[Hashable]:
+        """
+        Cache key for dict requests: the fiscal fingerprint when it can be derived
+        locally (manual params or parseable QR string), so the same receipt hits
+        the cache regardless of input format. Falls back to the raw QR string.
+        """
+        qr_string = request_data.get('qrraw')
+        if qr_string:
+            params = RequestBuilder.parse_qr_string(qr_string)
+            return params.fingerprint() if params else qr_string
+        try:
+            return (
+                request_data['fn'], request_data['fd'], request_data['fp'],
+                request_data['t'], request_data['n'], request_data['s']
+            )
+        except KeyError:
+            return None
+
+    def _decode_response(self, content: bytes) -> Dict:
+        """Decode API response body, dropping the HTML rendering unless keep_html is set"""
+        result = json_loads(content)
+        if not self.keep_html:
+            data = result.get('data')
+            if isinstance(data, dict):
+                data.pop('html', None)
+        return result
+
+    @staticmethod
+    def _negative_key(request_dict: Dict[str, str]) -> Hashable:
+        """Key for the known-bad cache: every request field except the token"""
+        return tuple(sorted((key, value) for key, value in request_dict.items() if key != 'token'))
+
+    def _lookup_cache(self, cache_key: Optional[Hashable], request_dict: Dict[str, str]) -> Optional[Receipt]:
+        """Return cached permanent error for this exact request, or cached receipt for the key"""
+        if not cache_key:
+            return None
+        if self.negative_cache.cache:
+            rejected = self.negative_cache.get(self._negative_key(request_dict))
+            if rejected:
+                return rejected
+        return self.cache.get(cache_key)
+
+    def _handle_result(
+            self,
+            result: Dict,
+            cache_key: Optional[Hashable],
+            request_dict: Dict[str, str],
+            attempt: int
+    ) -> Tuple[Optional[Receipt], float]:
+        """
+        Interpret decoded API response.
+
+        Returns:
+            (receipt, 0.0) when finished, or (None, delay) when the request should be retried
+        """
+        code = result.get('code', -1)
+
+        # Success case
+        if code == 1:
+            formed_receipt = Receipt.from_api_response(result, keep_raw=self.keep_raw)
+            # Store receipt in cache with cache key
+            if cache_key and formed_receipt.is_valid:
+                self.cache.put(cache_key, formed_receipt)
+            return formed_receipt, 0.0
+
+        # Retry case
+        if self.retry_handler.should_retry(code):
+            if attempt < self.retry_handler.max_retries - 1:
+                delay = self.retry_handler.get_delay(code, attempt)
+                logger.info(
+                    f"Code {code} received, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.retry_handler.max_retries})")
+                return None, delay
+
+        # Non-retryable error
+        error_receipt = Receipt.from_api_response(result)
+        if cache_key and code in _PERMANENT_ERROR_CODES:
+            self.negative_cache.put(self._negative_key(request_dict), error_receipt)
+        return error_receipt, 0.0
+
     def get_cache_stats(self) -> Dict[str, Union[int, str]]:
-        """Return cache performance statistics"""
-        return self.cache.stats()
+        """Return cache performance statistics (known-bad hits count as hits)"""
+        stats = self.cache.stats()
+        hits = self.cache.hits + self.negative_cache.hits
+        total = hits + self.cache.misses
+        stats['hits'] = hits
+        stats['hit_rate'] = f"{(hits / total * 100) if total > 0 else 0:.2f}%"
+        return stats
 
     def clear_cache(self):
-        """Clear the receipt cache"""
+        """Clear the receipt cache and known-bad receipts"""
         self.cache.clear()
+        self.negative_cache.clear()
+
+    def close(self):
+        """Close pooled HTTP connections"""
+        self.session.close()
+
+class AsyncReceiptVerifier(ReceiptVerifier):
+    """
+    asyncio receipt verifier backed by a pooled aiohttp session.
+
+    Shares caching, retry policy and response handling with ReceiptVerifier,
+    but waits with asyncio.sleep so many receipts can be in flight at once.
+    Requires the optional 'aiohttp' package.
+    """
+    def __init__(
+            self,
+            token: str,
+            max_retries: int = 3,
+            cache_size: int = 1000,
+            keep_html: bool = False,
+            keep_raw: bool = False,
+            concurrency: int = 10
+    ):
+        if aiohttp is None:
+            raise ImportError("AsyncReceiptVerifier requires the 'aiohttp' package")
+        super().__init__(
+            token,
+            max_retries=max_retries,
+            cache_size=cache_size,
+            keep_html=keep_html,
+            keep_raw=keep_raw
+        )
+        self.concurrency = concurrency
+        self._http: Optional['aiohttp.ClientSession'] = None
+
+    def _get_http(self) -> 'aiohttp.ClientSession':
+        """Create the aiohttp session lazily (it must be bound to a running loop)"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession()
+        return self._http
+
+    async def verify_receipt_async(
+            self,
+            request_data: Union[Dict[str, str], RequestParams],
+            files: Optional[Dict] = None,
+            promo_id: Optional[int] = None,
+            userdata: Optional[Dict[str, str]] = None,
+            session: Optional['aiohttp.ClientSession'] = None,
+            use_cache: bool = True
+    ) -> Receipt:
+        """
+        Verify receipt without blocking the event loop.
+
+        Args:
+            request_data: Request parameters (Dict for qrraw/qrurl, RequestParams for manual)
+            files: Optional file dict for qrfile format
+            promo_id: Optional promo campaign ID
+            userdata: Optional custom parameters (userdata_<key>=value)
+            session: Optional caller-owned aiohttp session (default: the verifier's own)
+            use_cache: Look up cached results first (False forces an API call; the result is still cached)
+
+        Returns:
+            Receipt object with verification result
+        """
+        cache_key, request_dict = self._prepare_request(request_data, promo_id, userdata)
+
+        # Check cache
+        if use_cache:
+            cached = self._lookup_cache(cache_key, request_dict)
+            if cached:
+                return cached
+
+        # Read uploads once so every attempt can resend them
+        uploads = {}
+        if files:
+            for key, f in files.items():
+                uploads[key] = (os.path.basename(getattr(f, 'name', key)), f.read())
+                f.close()
+
+        body = None if uploads else urlencode(request_dict)
+        headers = None if uploads else _FORM_HEADERS
+
+        http = session if session is not None else self._get_http()
+        for attempt in range(self.retry_handler.max_retries):
+            try:
+                data = body if body is not None else self._multipart(request_dict, uploads)
+                async with http.post(self.api_url, data=data, headers=headers) as response:
+                    response.raise_for_status()
+                    result = self._decode_response(await response.read())
 
-# Save raw response as json file
+                formed_receipt, delay = self._handle_result(result, cache_key, request_dict, attempt)
+                if formed_receipt is not None:
+                    return formed_receipt
+                await asyncio.sleep(delay)
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"Request failed: {e}")
+                if attempt < self.retry_handler.max_retries - 1:
+                    delay = self.retry_handler.get_network_delay(attempt)
+                    logger.info(f"Network error, retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                else:
+                    return Receipt(
+                        code=-1,
+                        is_valid=False,
+                        error_message=f"Network error: {str(e)}",
+                        date_time=datetime.now()
+                    )
+
+        return Receipt(
+            code=-1,
+            is_valid=False,
+            error_message="Max retries exceeded",
+            date_time=datetime.now()
+        )
+
+    async def verify_many(self, batch: Iterable[Union[Dict[str, str], RequestParams]]) -> List[Receipt]:
+        """Verify several receipts concurrently, at most `concurrency` at a time"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(request_data: Union[Dict[str, str], RequestParams]) -> Receipt:
+            async with semaphore:
+                return await self.verify_receipt_async(request_data)
+
+        return list(await asyncio.gather(*(bounded(request_data) for request_data in batch)))
+
+    async def aclose(self):
+        """Close pooled HTTP connections"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        self.close()
+
+    @staticmethod
+    def _multipart(request_dict: Dict[str, str], uploads: Dict[str, Tuple[str, bytes]]) -> 'aiohttp.FormData':
+        """Multipart form with fields and uploaded files (rebuilt per attempt)"""
+        form = aiohttp.FormData()
+        for key, value in request_dict.items():
+            form.add_field(key, value)
+        for key, (filename, content) in uploads.items():
+            form.add_field(key, content, filename=filename)
+        return form
+
+# Save raw response as json file (receipt must come from a verifier with keep_raw=True)
 def save_json(_receipt: Receipt):
+    # Nothing to save: error receipt, or verifier created without keep_raw=True
+    if not _receipt.raw_response:
+        logger.warning("Receipt has no raw response (use ReceiptVerifier(keep_raw=True)), JSON not saved")
+        return
+
     # Specify the file path
     file_path = f"receipt_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{_receipt.fiscal_drive_number}_{_receipt.fiscal_document_number}.json"
     data = _receipt.raw_response
 
-    # Open the file in write mode ('w') and use json.dump() to write the dictionary
-    with open(file_path, 'w') as json_file:
-        json.dump(data, json_file, indent=4) # indent=4 for pretty-printing
+    # Open the file in binary mode and write the pre-encoded, pretty-printed JSON
+    with open(file_path, 'wb') as json_file:
+        json_file.write(json_dumps(data, indent=True))
     print(f"Dictionary saved to {file_path}")
 
 def print_receipt(_receipt: Receipt):
@@ -546,7 +988,7 @@ def from_qr_img(_file_path: str) -> Receipt:
 # Example usage
 if __name__ == "__main__":
     TOKEN = " "
-    verifier = ReceiptVerifier(TOKEN, max_retries=3, cache_size=100)
+    verifier = ReceiptVerifier(TOKEN, max_retries=3, cache_size=100, keep_raw=True)
 
     # # Example 1: Verify from QR string (most common)
     # qr_string = "t=...&s=...&fn=...&i=...&fp=...&n=1"
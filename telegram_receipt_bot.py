@@ -12,15 +12,24 @@ Features:
 import asyncio
 import logging
 import os
-from typing import Dict, Optional, List, Callable
+import re
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Callable, Set, Tuple
 from pathlib import Path
-import glob
+from types import MappingProxyType
 import json
 import hashlib
-from datetime import datetime, timedelta
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+from urllib.parse import parse_qsl
 
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+import aiohttp
+from telegram import CallbackQuery, Message, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -28,11 +37,20 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    Defaults,
     filters,
 )
 
+uvloop = None
+if sys.platform != 'win32':
+    try:
+        import uvloop  # Optional: faster event loop (not available on Windows)
+    except ImportError:
+        pass
+
 # Import receipt verification logic
-from receipt_verifier import ReceiptVerifier, RequestBuilder, Receipt, RequestParams
+from receipt_verifier import AsyncReceiptVerifier, RequestBuilder, Receipt, RequestParams, json_dumps, json_loads
+from callback_parse import is_short_hash, parse_download_callback, parse_reverify_manual, parse_reverify_qr
 
 # Configure logging
 logging.basicConfig(
@@ -41,22 +59,232 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Conversation states
-ASKING_FN, ASKING_FD, ASKING_FP, ASKING_T, ASKING_N, ASKING_S = range(6)
+# Conversation state (current manual entry step is kept in user_data['_step'])
+ASKING_PARAM = 0
 
 # API rate limiting
 MAX_DAILY_REQUESTS = 15
 
+# Worker threads for blocking file I/O (CSV reads/writes)
+IO_WORKERS = 4
+
+# Shared HTTP connection pool for receipt API calls
+HTTP_POOL_LIMIT = 32
+HTTP_DNS_TTL = 300
+HTTP_KEEPALIVE = 60
+
+# Callback hash lookups: max entries (least recently used evicted first) and lifetime in seconds
+QR_CACHE_SIZE = 4096
+QR_CACHE_TTL = 3600
+
+# On-disk store behind qr_cache so callbacks survive restarts (entries kept for a week)
+QR_STORE_FILE = "qr_cache.sqlite"
+QR_STORE_TTL = 7 * 24 * 3600
+
+# QR string must contain t=, s= and fn= (in any order)
+_REQUIRED_QR = ('t=', 's=', 'fn=')
+
+# Manual entry validators (ASCII digits only, length-bounded)
+_FN_RE = re.compile(r'\d{16}', re.ASCII)
+_FD_RE = re.compile(r'\d{1,10}', re.ASCII)
+_FP_RE = re.compile(r'\d{1,10}', re.ASCII)
+_T_RE = re.compile(r'\d{8}T\d{4}', re.ASCII)
+
 # Standard main menu keyboard - reused everywhere
 MAIN_MENU_KEYBOARD = [
     ['📱 Распознать из QR строки'],
     ['⌨️ Ввод параметров вручную'],
     ['📊 Статистика', '❓ Help']
 ]
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup(MAIN_MENU_KEYBOARD, resize_keyboard=True)
+
+# Cancel keyboard shown during manual entry steps
+CANCEL_BUTTON = '❌ Отмена и возврат в меню'
+CANCEL_MARKUP = ReplyKeyboardMarkup([[CANCEL_BUTTON]], resize_keyboard=True)
+
+# Message filters shared by handler registrations
+_MANUAL_ENTRY_FILTER = filters.Regex('^⌨️ Ввод параметров вручную$')
+_MENU_BUTTON_FILTER = filters.Regex('^(📱|📊|❓)')
+_TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _short_hash(text: str) -> str:
+    """8-char hex digest used to fit long values into callback_data."""
+    return hashlib.blake2b(text.encode(), digest_size=4).hexdigest()
+
+def _is_amount(text: str) -> bool:
+    """Check that text parses as a ruble amount."""
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
+
+# Manual entry steps: (user_data key, validator, error reply, prompt for next step).
+# The last step has no prompt - it triggers verification.
+_MANUAL_STEPS: Tuple[Tuple[str, Callable[[str], object], str, Optional[str]], ...] = (
+    (
+        'fn', _FN_RE.fullmatch,
+        "❌ ФН должен состоять из 16 цифр. Попробуйте снова:",
+        "✅ ФН сохранен\n\n"
+        "Шаг 2/6: Введите *номер Фискального Документа* (ФД)\n"
+        "Пример: `1145`",
+    ),
+    (
+        'fd', _FD_RE.fullmatch,
+        "❌ ФД должен быть числом (до 10 цифр). Попробуйте снова:",
+        "✅ ФД сохранен\n\n"
+        "Шаг 3/6: Введите *Фискальный признак документа* (ФП)\n"
+        "Пример: `3909409245`",
+    ),
+    (
+        'fp', _FP_RE.fullmatch,
+        "❌ ФП должен быть числом (до 10 цифр). Попробуйте снова:",
+        "✅ ФП сохранен\n\n"
+        "Шаг 4/6: Введите *Дату и время*\n"
+        "Формат: `ГГГГММДДТЧЧмм`\n"
+        "Пример: `20250101T1212`",
+    ),
+    (
+        't', _T_RE.fullmatch,
+        "❌ Неправильный формат. Используйте ГГГГММДДТЧЧмм\n"
+        "Пример: `20250101T1212`",
+        "✅ Дата и время сохранены\n\n"
+        "Шаг 5/6: Введите *Вид чека* (n)\n"
+        "• 1 - Приход\n"
+        "• 2 - Возврат прихода\n"
+        "• 3 - Расход\n"
+        "• 4 - Возврат расхода",
+    ),
+    (
+        'n', frozenset(('1', '2', '3', '4')).__contains__,
+        "❌ Должен быть 1, 2, 3, или 4. Попробуйте снова:",
+        "✅ Вид чека сохранен\n\n"
+        "Шаг 6/6: Введите *Итог* в рублях\n"
+        "Пример: `1000.00` or `1000`",
+    ),
+    (
+        's', _is_amount,
+        "❌ Итог должен быть в цифрах. Попробуйте снова:",
+        None,
+    ),
+)
 
 def get_main_menu_markup() -> ReplyKeyboardMarkup:
-    """Get standard main menu keyboard markup."""
-    return ReplyKeyboardMarkup(MAIN_MENU_KEYBOARD, resize_keyboard=True)
+    """Get standard main menu keyboard markup (shared immutable instance)."""
+    return MAIN_MENU_MARKUP
+
+# Inline button labels (only callback_data varies per message)
+_DOWNLOAD_BUTTON_LABEL = "📥 Загрузить CSV"
+_DOWNLOAD_SAVED_BUTTON_LABEL = "📥 Загрузить сохраненный"
+_REVERIFY_BUTTON_LABEL = "🔄 Повторный запрос"
+
+def _download_markup(cb: str) -> InlineKeyboardMarkup:
+    """Single download button for a freshly saved receipt."""
+    return InlineKeyboardMarkup.from_button(InlineKeyboardButton(_DOWNLOAD_BUTTON_LABEL, callback_data=cb))
+
+def _saved_receipt_markup(download_cb: str, reverify_cb: str) -> InlineKeyboardMarkup:
+    """Download / re-verify choice for an already saved receipt."""
+    return InlineKeyboardMarkup.from_column([
+        InlineKeyboardButton(_DOWNLOAD_SAVED_BUTTON_LABEL, callback_data=download_cb),
+        InlineKeyboardButton(_REVERIFY_BUTTON_LABEL, callback_data=reverify_cb)
+    ])
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU mapping with per-entry expiry.
+    
+    Stores (value, monotonic deadline) pairs; expired entries are dropped
+    when looked up, and the least recently used entry is evicted on insert
+    once maxsize is exceeded. Reads refresh recency but not the deadline.
+    """
+    
+    def __init__(self, maxsize: int = QR_CACHE_SIZE, ttl: float = QR_CACHE_TTL):
+        self._data: 'OrderedDict[str, Tuple[Any, float]]' = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return live value for key (marking it recently used) or default."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, deadline = entry
+        if deadline < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+        
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+        
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+        
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CallbackStore:
+    """
+    SQLite (WAL mode) key-value store for callback hash mappings.
+    
+    Second tier behind the in-memory TTLCache: survives restarts so buttons
+    on old messages keep working. Methods are blocking and meant to be run
+    in an executor; a lock serializes access to the shared connection.
+    """
+    
+    def __init__(self, path: str = QR_STORE_FILE, ttl: int = QR_STORE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS qr(h TEXT PRIMARY KEY, v TEXT, ts INTEGER)')
+        # Drop expired entries once at startup
+        self._db.execute('DELETE FROM qr WHERE ts < ?', (int(time.time()) - self.ttl,))
+        
+    def put(self, key: str, value: str) -> None:
+        """Store or refresh a mapping."""
+        try:
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO qr(h, v, ts) VALUES (?, ?, ?)',
+                    (key, value, int(time.time()))
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error writing {key} to callback store: {e}")
+            
+    def get(self, key: str) -> Optional[str]:
+        """Return the stored value if present and not expired."""
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT v FROM qr WHERE h = ? AND ts >= ?',
+                    (key, int(time.time()) - self.ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading {key} from callback store: {e}")
+            return None
+        return row[0] if row else None
+        
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
 
 class AuthManager:
     """
@@ -71,36 +299,34 @@ class AuthManager:
     
     def __init__(self, auth_file: str = "authorized_users.json"):
         self.auth_file = auth_file
-        self.authorized_users: List[int] = []
+        self.authorized_users: FrozenSet[int] = frozenset()
         self.admin_contact: str = ""
         self._load_authorized_users()
         
     def _load_authorized_users(self):
-        if not os.path.exists(self.auth_file):
+        try:
+            with open(self.auth_file, 'rb') as f:
+                data = json_loads(f.read())
+                self.authorized_users = frozenset(data.get('authorized_users', []))
+                self.admin_contact = data.get('admin_contact', '@admin')
+                logger.info(f"Loaded {len(self.authorized_users)} authorized users")
+        except FileNotFoundError:
             logger.warning(f"{self.auth_file} not found, creating default file")
             default_data = {
                 "authorized_users": [],
                 "admin_contact": "@admin"
             }
-            with open(self.auth_file, 'w') as f:
-                json.dump(default_data, f, indent=2)
-            self.authorized_users = []
+            with open(self.auth_file, 'wb') as f:
+                f.write(json_dumps(default_data, indent=True))
+            self.authorized_users = frozenset()
             self.admin_contact = "@admin"
-            return
-            
-        try:
-            with open(self.auth_file, 'r') as f:
-                data = json.load(f)
-                self.authorized_users = data.get('authorized_users', [])
-                self.admin_contact = data.get('admin_contact', '@admin')
-                logger.info(f"Loaded {len(self.authorized_users)} authorized users")
         except (json.JSONDecodeError, KeyError) as e:
             logger.error(f"Error loading {self.auth_file}: {e}")
-            self.authorized_users = []
+            self.authorized_users = frozenset()
             self.admin_contact = "@admin"
             
     def is_authorized(self, user_id: int) -> bool:
-        """Check if user is authorized."""
+        """Check if user is authorized (O(1) set lookup)."""
         return user_id in self.authorized_users
         
     def get_admin_contact(self) -> str:
@@ -112,6 +338,29 @@ class AuthManager:
         self._load_authorized_users()
 
 
+# Reply for users not listed in authorized_users.json
+_UNAUTH_TEMPLATE = (
+    "🔒 *Доступ запрещен*\n\n"
+    "У вас нет прав доступа к этому боту.\n"
+    "Свяжитесь с администратором {admin} для доступа.\n\n"
+    "Ваш ID: `{uid}`"
+)
+
+# /stats reply, filled from verifier cache stats and rate limiter stats
+_STATS_TEMPLATE = (
+    "📊 *Статистика*\n\n"
+    "*Кэширование:*\n"
+    "Hits: {hits}\n"
+    "Misses: {misses}\n"
+    "Hit Rate: {hit_rate}\n"
+    "Cached: {size}\n\n"
+    "*API использование (сегодня):*\n"
+    "Использовано: {used}/{limit}\n"
+    "Осталось: {remaining}\n"
+    "Дата: {date}"
+)
+
+
 def require_auth(func: Callable):
     """Decorator to restrict handler access to authorized users only."""
     @wraps(func)
@@ -120,14 +369,10 @@ def require_auth(func: Callable):
         if not user:
             return
             
-        if not self.auth_manager.is_authorized(user.id):
+        if not self._is_authorized(user.id):
             logger.warning(f"Unauthorized access attempt by user {user.id} (@{user.username})")
             await update.message.reply_text(
-                "🔒 *Доступ запрещен*\n\n"
-                f"У вас нет прав доступа к этому боту.\n"
-                f"Свяжитесь с администратором {self.auth_manager.get_admin_contact()} для доступа.\n\n"
-                f"Ваш ID: `{user.id}`",
-                parse_mode='Markdown'
+                _UNAUTH_TEMPLATE.format(admin=self.auth_manager.get_admin_contact(), uid=user.id)
             )
             return
             
@@ -135,6 +380,33 @@ def require_auth(func: Callable):
     return wrapper
 
 
+class RateLimitReservation:
+    """
+    One request reserved under the daily limit.
+    
+    Used as a context manager around the work that spends it: on exit the
+    request is given back to the limiter unless keep() was called.
+    """
+    
+    __slots__ = ('_limiter', '_day', '_kept')
+    
+    def __init__(self, limiter: 'APIRateLimiter', day: str):
+        self._limiter = limiter
+        self._day = day
+        self._kept = False
+        
+    def keep(self) -> None:
+        """Count the request against the limit for good."""
+        self._kept = True
+        
+    def __enter__(self) -> 'RateLimitReservation':
+        return self
+        
+    def __exit__(self, *exc_info) -> None:
+        if not self._kept:
+            self._limiter.release(self._day)
+
+
 class APIRateLimiter:
     """
     Track daily API request count with persistent JSON storage.
@@ -142,7 +414,11 @@ class APIRateLimiter:
     Uses simple date-based tracking:
     - Stores requests as {"date": "YYYY-MM-DD", "count": N}
     - Resets counter when date changes
-    - Thread-safe for single-process deployment
+    - Keeps state in memory; the file is read once at startup and
+      written only on reservation changes and day rollover
+    - Safe for single-process deployment: try_acquire() checks and counts in
+      one synchronous step on the event loop, so concurrent handlers can't
+      overshoot the limit while their API calls are in flight
     
     File format: api_requests.json
     """
@@ -150,61 +426,82 @@ class APIRateLimiter:
     def __init__(self, limit: int = MAX_DAILY_REQUESTS, tracking_file: str = "api_requests.json"):
         self.limit = limit
         self.tracking_file = tracking_file
-        self._ensure_file_exists()
-        
-    def _ensure_file_exists(self):
-        """Create tracking file if it doesn't exist."""
-        if not os.path.exists(self.tracking_file):
-            self._write_data({"date": datetime.now().strftime("%Y-%m-%d"), "count": 0})
+        # Keep the tracking file open; rewrites reuse the descriptor
+        self._fd = os.open(tracking_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        self._data = self._read_data()
+        self._today: Optional[date] = None  # date self._data was last checked against
+        self._current()
             
     def _read_data(self) -> Dict:
         """Read tracking data from JSON file."""
         try:
-            with open(self.tracking_file, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            # Corrupted or missing file - reset
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            return json_loads(os.read(self._fd, os.fstat(self._fd).st_size))
+        except json.JSONDecodeError:
+            # Corrupted or new empty file - reset
             default_data = {"date": datetime.now().strftime("%Y-%m-%d"), "count": 0}
             self._write_data(default_data)
             return default_data
             
     def _write_data(self, data: Dict):
-        """Write tracking data to JSON file."""
-        with open(self.tracking_file, 'w') as f:
-            json.dump(data, f, indent=2)
+        """Overwrite tracking file in place with compact JSON."""
+        payload = json_dumps(data)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, payload)
+        os.ftruncate(self._fd, len(payload))
+
+    def close(self):
+        """Close tracking file descriptor."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
             
-    def _reset_if_new_day(self, data: Dict) -> Dict:
+    def _reset_if_new_day(self, data: Dict, today: str) -> Dict:
         """Reset counter if date has changed."""
-        today = datetime.now().strftime("%Y-%m-%d")
         if data.get("date") != today:
             data = {"date": today, "count": 0}
             self._write_data(data)
         return data
+
+    def _current(self) -> Dict:
+        """Get in-memory tracking data, rolled over to today."""
+        today = datetime.now().date()
+        if today != self._today:
+            # Only format and compare date strings when the day changes
+            self._today = today
+            self._data = self._reset_if_new_day(self._data, today.isoformat())
+        return self._data
+        
+    def try_acquire(self) -> Optional[RateLimitReservation]:
+        """
+        Reserve one request under the daily limit.
         
-    def can_make_request(self) -> bool:
-        """Check if request is allowed under daily limit."""
-        data = self._read_data()
-        data = self._reset_if_new_day(data)
-        return data["count"] < self.limit
-        
-    def increment(self):
-        """Increment request counter."""
-        data = self._read_data()
-        data = self._reset_if_new_day(data)
+        Returns:
+            Reservation (released on exit unless kept) or None if the limit is reached
+        """
+        data = self._current()
+        if data["count"] >= self.limit:
+            return None
         data["count"] += 1
         self._write_data(data)
         logger.info(f"API request count: {data['count']}/{self.limit}")
+        return RateLimitReservation(self, data["date"])
+        
+    def release(self, day: str):
+        """Give back a request reserved on day (no-op once the day has rolled over)."""
+        data = self._current()
+        if data["date"] == day and data["count"] > 0:
+            data["count"] -= 1
+            self._write_data(data)
+            logger.info(f"API request released: {data['count']}/{self.limit}")
         
     def get_remaining(self) -> int:
         """Get remaining requests for today."""
-        data = self._read_data()
-        data = self._reset_if_new_day(data)
-        return max(0, self.limit - data["count"])
+        return max(0, self.limit - self._current()["count"])
         
     def get_stats(self) -> Dict:
         """Get current statistics."""
-        data = self._read_data()
-        data = self._reset_if_new_day(data)
+        data = self._current()
         return {
             "date": data["date"],
             "used": data["count"],
@@ -218,7 +515,8 @@ class ReceiptBot:
     Main bot controller with file-based receipt caching.
     
     Architecture:
-    - Filesystem-based duplicate detection
+    - Duplicate detection via in-memory (fn, fd, fp) index of saved CSVs,
+      built from the receipts directory at startup
     - Standardized CSV naming: YYYY-MM-DD_HH-MM-SS_fn_fd_fp.csv
     """
     
@@ -226,33 +524,145 @@ class ReceiptBot:
         self.telegram_token = telegram_token
         self.receipts_dir = receipts_dir
         
-        # Create receipts directory
+        # Create receipts directory and index saved receipts
         Path(self.receipts_dir).mkdir(exist_ok=True)
+        self._receipt_index: Dict[Tuple[str, str, str], str] = {}
+        self._known_files: Set[str] = set()
+        self._index_mtime_ns = 0
+        self._index_receipts()
 
-        # Initialize authorization manager
+        # Initialize authorization manager (bound check used on every update)
         self.auth_manager = AuthManager()
+        self._is_authorized = self.auth_manager.is_authorized
 
         # Initialize rate limiter
         self.rate_limiter = APIRateLimiter(limit=MAX_DAILY_REQUESTS)
         
-        # Receipt verifier with LRU cache and exponential backoff
-        self.verifier = ReceiptVerifier(
+        # Async receipt verifier with LRU cache and exponential backoff
+        self.verifier = AsyncReceiptVerifier(
             token=receipt_token,
             max_retries=3,
             cache_size=500
         )
 
-        # Store QR strings temporarily for reverify callbacks (hash -> qr_string)
-        self.qr_cache: Dict[str, str] = {}
+        # Pooled HTTP session for the verifier, opened in post_init on the bot's loop
+        self._http: Optional[aiohttp.ClientSession] = None
+
+        # Bounded pool for blocking file I/O (instead of the default to_thread executor)
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+        # Store QR strings and long filenames for callbacks (hash -> value), bounded LRU with TTL
+        self.qr_cache = TTLCache(maxsize=QR_CACHE_SIZE, ttl=QR_CACHE_TTL)
+        self._qr_store = CallbackStore()
+
+        # Main menu button text -> handler
+        self._button_handlers: Dict[str, Callable] = {
+            '📱 Распознать из QR строки': self._prompt_qr,
+            '📊 Статистика': self.stats_command,
+            '❓ Help': self.help_command,
+        }
 
         self.app: Optional[Application] = None
         
+    def _remember(self, key: str, value: str) -> None:
+        """Store callback hash mapping in memory and persist it in the background."""
+        self.qr_cache[key] = value
+        asyncio.get_running_loop().run_in_executor(self._io_pool, self._qr_store.put, key, value)
+        
+    async def _recall(self, key: str) -> Optional[str]:
+        """Resolve callback hash: memory first, then the on-disk store."""
+        value = self.qr_cache.get(key)
+        if value is None:
+            value = await asyncio.get_running_loop().run_in_executor(self._io_pool, self._qr_store.get, key)
+            if value is not None:
+                self.qr_cache[key] = value
+        return value
+        
+    def _download_callback_data(self, filename: str) -> str:
+        """
+        Build download callback_data for a CSV filename.
+        
+        Falls back to a short hash when the name exceeds Telegram's 64-byte
+        callback_data limit (measured in UTF-8 bytes: files added outside
+        the bot may have non-ASCII names).
+        """
+        download_data = f"download_{filename}"
+        if len(download_data.encode()) > 64:
+            file_hash = _short_hash(filename)
+            self._remember(file_hash, filename)
+            download_data = f"download_{file_hash}"
+            logger.info(f"Using hash instead: {download_data}")
+        return download_data
+        
+    @staticmethod
+    def _receipt_key(filename: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Extract (fn, fd, fp) from a CSV name: YYYY-MM-DD_HH-MM-SS_fn_fd_fp.csv
+        
+        Returns:
+            Key tuple or None if the name doesn't match the format
+        """
+        if not filename.endswith('.csv'):
+            return None
+        parts = filename[:-4].rsplit('_', 3)
+        if len(parts) != 4:
+            return None
+        return parts[1], parts[2], parts[3]
+        
+    def _index_receipts(self) -> None:
+        """Scan receipts directory; rebuild the fiscal-parameter index and known file names."""
+        self._index_mtime_ns = os.stat(self.receipts_dir).st_mtime_ns
+        index: Dict[Tuple[str, str, str], str] = {}
+        known: Set[str] = set()
+        with os.scandir(self.receipts_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                known.add(entry.name)
+                key = self._receipt_key(entry.name)
+                if key:
+                    index[key] = entry.path
+        self._receipt_index = index
+        self._known_files = known
+                    
+    def _forget_receipt(self, filename: str) -> None:
+        """Drop a CSV that turned out to be missing from the index and known names."""
+        self._known_files.discard(filename)
+        key = self._receipt_key(filename)
+        if key and self._receipt_index.get(key) == os.path.join(self.receipts_dir, filename):
+            del self._receipt_index[key]
+            
+    def _dir_mtime_ns(self) -> Optional[int]:
+        """Receipts directory mtime in ns, or None if it doesn't exist."""
+        try:
+            return os.stat(self.receipts_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+            
+    def _save_csv(self, receipt: Receipt) -> Tuple[Optional[str], Optional[int], Optional[int]]:
+        """Write receipt CSV (blocking); return its path and the directory mtime before and after."""
+        mtime_before = self._dir_mtime_ns()
+        csv_filename = receipt.to_csv(receipts_dir=self.receipts_dir)
+        return csv_filename, mtime_before, self._dir_mtime_ns()
+        
+    def _refresh_index(self) -> None:
+        """Rescan receipts directory only if it changed since the last scan (recreate it if removed)."""
+        mtime_ns = self._dir_mtime_ns()
+        if mtime_ns is None:
+            logger.warning(f"Receipts directory {self.receipts_dir} was removed, recreating it")
+            Path(self.receipts_dir).mkdir(exist_ok=True)
+            self._index_receipts()
+            return
+        if mtime_ns != self._index_mtime_ns:
+            self._index_receipts()
+            
     def _find_existing_receipt(self, params: Dict[str, str]) -> Optional[str]:
         """
-        Search for existing receipt CSV by fiscal parameters.
+        Look up existing receipt CSV by fiscal parameters.
         
-        Uses glob pattern: *_<fn>_<fd>_<fp>.csv
-        Time Complexity: O(n) where n = number of files
+        Time Complexity: O(1) dict lookup in the receipt index, after one
+        stat of the directory; it is rescanned with os.scandir only if its
+        mtime changed, so files added or deleted outside the bot are noticed.
         
         Args:
             params: Dict with 'fn', 'fd', 'fp' keys
@@ -267,10 +677,8 @@ class ReceiptBot:
         if not (fn and fd and fp):
             return None
             
-        pattern = os.path.join(self.receipts_dir, f"*_{fn}_{fd}_{fp}.csv")
-        matches = glob.glob(pattern)
-        
-        return matches[0] if matches else None
+        self._refresh_index()
+        return self._receipt_index.get((fn, fd, fp))
         
     def _extract_params_from_qr(self, qr_string: str) -> Dict[str, str]:
         """
@@ -282,16 +690,12 @@ class ReceiptBot:
         Returns:
             Dict with fn, fd, fp keys
         """
-        params = {}
-        for pair in qr_string.split('&'):
-            if '=' in pair:
-                key, value = pair.split('=', 1)
-                if key in ['fn', 'fd', 'fp', 'i']:
-                    params[key] = value
+        fields = dict(parse_qsl(qr_string, keep_blank_values=True))
+        params = {key: fields[key] for key in ('fn', 'fd', 'fp') if key in fields}
         
         # API uses 'i' for fiscal document number
-        if 'i' in params:
-            params['fd'] = params['i']
+        if 'i' in fields:
+            params['fd'] = fields['i']
             
         return params
         
@@ -300,13 +704,9 @@ class ReceiptBot:
         user = update.effective_user
         
         # Check authorization
-        if not self.auth_manager.is_authorized(user.id):
+        if not self._is_authorized(user.id):
             await update.message.reply_text(
-                "🔒 *Доступ запрещен*\n\n"
-                f"У вас нет прав доступа к этому боту.\n"
-                f"Свяжитесь с администратором {self.auth_manager.get_admin_contact()} для доступа.\n\n"
-                f"Ваш ID: `{user.id}`",
-                parse_mode='Markdown'
+                _UNAUTH_TEMPLATE.format(admin=self.auth_manager.get_admin_contact(), uid=user.id)
             )
             return
         
@@ -319,8 +719,7 @@ class ReceiptBot:
         )
         await update.message.reply_text(
             welcome_msg,             
-            reply_markup=get_main_menu_markup(), 
-            parse_mode='Markdown'
+            reply_markup=get_main_menu_markup()
         )
     
     @require_auth    
@@ -328,8 +727,7 @@ class ReceiptBot:
         """Handle /menu command - explicit return to main menu."""
         await update.message.reply_text(
             "📋 *Главное меню*\n\nВыберите действие:",
-            reply_markup=get_main_menu_markup(),
-            parse_mode='Markdown'
+            reply_markup=get_main_menu_markup()
         )
 
     @require_auth    
@@ -351,16 +749,6 @@ class ReceiptBot:
         )
         await update.message.reply_text(
             help_text, 
-            parse_mode='Markdown',
-            reply_markup=get_main_menu_markup()
-        )
-
-    @require_auth    
-    async def menu_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Handle /menu command - explicit return to main menu."""
-        await update.message.reply_text(
-            "📋 *Главное меню*\n\nВыберите действие:",
-            parse_mode='Markdown',
             reply_markup=get_main_menu_markup()
         )
 
@@ -370,21 +758,8 @@ class ReceiptBot:
         cache_stats = self.verifier.get_cache_stats()
         api_stats = self.rate_limiter.get_stats()
         
-        stats_msg = (
-            f"📊 *Статистика*\n\n"
-            f"*Кэширование:*\n"
-            f"Hits: {cache_stats['hits']}\n"
-            f"Misses: {cache_stats['misses']}\n"
-            f"Hit Rate: {cache_stats['hit_rate']}\n"
-            f"Cached: {cache_stats['size']}\n\n"
-            f"*API использование (сегодня):*\n"
-            f"Использовано: {api_stats['used']}/{api_stats['limit']}\n"
-            f"Осталось: {api_stats['remaining']}\n"
-            f"Дата: {api_stats['date']}"
-        )
         await update.message.reply_text(
-            stats_msg, 
-            parse_mode='Markdown',
+            _STATS_TEMPLATE.format(**cache_stats, **api_stats), 
             reply_markup=get_main_menu_markup()
         )
 
@@ -403,11 +778,10 @@ class ReceiptBot:
         qr_string = update.message.text.strip()
         
         # Validate QR format
-        if not all(param in qr_string for param in ['t=', 's=', 'fn=']):
+        if not all(part in qr_string for part in _REQUIRED_QR):
             await update.message.reply_text(
                 "❌ Неправильный форма QR строки. Ожидается:\n"
                 "`t=...&s=...&fn=...&i=...&fp=...&n=1`",
-                parse_mode='Markdown',
                 reply_markup=get_main_menu_markup()
             )
             return
@@ -422,218 +796,90 @@ class ReceiptBot:
             # Found existing receipt - offer choices
             filename = os.path.basename(existing_file)
             
-            # Check if filename is too long for callback_data (Telegram 64-byte limit)
-            download_data = f"download_{filename}"
-            logger.info(f"Download callback_data length: {len(download_data.encode('utf-8'))} bytes: {download_data}")
-            
-            if len(download_data.encode('utf-8')) > 64:
-                file_hash = hashlib.md5(filename.encode()).hexdigest()[:8]
-                self.qr_cache[file_hash] = filename
-                download_data = f"download_{file_hash}"
-                logger.info(f"Using hash instead: {download_data}")
+            download_data = self._download_callback_data(filename)
             
             # Use hash for QR string to stay under 64-byte callback_data limit
-            qr_hash = hashlib.md5(qr_string.encode()).hexdigest()[:8]
-            self.qr_cache[qr_hash] = qr_string
+            qr_hash = _short_hash(qr_string)
+            self._remember(qr_hash, qr_string)
             reverify_data = f"reverify_qr_{qr_hash}"
-            logger.info(f"Reverify callback_data length: {len(reverify_data.encode('utf-8'))} bytes: {reverify_data}")
 
-            keyboard = [
-                [InlineKeyboardButton("📥 Загрузить сохраненный", callback_data=download_data)],
-                [InlineKeyboardButton("🔄 Повторный запрос", callback_data=reverify_data)]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = _saved_receipt_markup(download_data, reverify_data)
             
             await update.message.reply_text(
                 f"✅ *Чек уже сохранен*\n\n"
                 f"Файл: `{os.path.basename(existing_file)}`\n\n"
                 f"Выберите действие:",
-                parse_mode='Markdown',
                 reply_markup=reply_markup
             )
             return
         
-        # Check rate limit before API call
-        if not self.rate_limiter.can_make_request():
-            remaining = self.rate_limiter.get_remaining()
-            await update.message.reply_text(
-                f"⚠️ *Дневной лимит запросов достигнут*\n\n"
-                f"Не более {MAX_DAILY_REQUESTS} запросовв день.\n"
-                f"Осталось сегодня: {remaining}\n\n"
-                f"Попробуйте завтра или загрузите имеющиеся чеки.",
-                parse_mode='Markdown',
-                reply_markup=get_main_menu_markup()
-            )
+        # Reserve a request slot before any await
+        reservation = self.rate_limiter.try_acquire()
+        if reservation is None:
+            await self._reply_limit_reached(update.message)
             return
             
         # No existing file and under limit - proceed with API verification
-        await update.message.reply_text("🔄 Отправляется запрос через API...")
-        await update.message.chat.send_action('typing')
-        
-        try:
-            request = RequestBuilder.from_qr_string(qr_string)
-            receipt = await asyncio.to_thread(self.verifier.verify_receipt, request)
-            
-            # Only increment counter if API call was successful
-            if receipt.is_valid:
-                self.rate_limiter.increment()
+        with reservation:
+            try:
+                await asyncio.gather(
+                    update.message.reply_text("🔄 Отправляется запрос через API..."),
+                    update.message.chat.send_action('typing')
+                )
                 
-            await self._send_receipt_result(update, receipt)
-            
-        except Exception as e:
-            logger.error(f"Неудачная попытка верификации: {e}", exc_info=True)
-            await update.message.reply_text(
-                f"❌ Ошибка: {str(e)}",
-                reply_markup=get_main_menu_markup()
-            )
+                request = RequestBuilder.from_qr_string(qr_string)
+                receipt = await self._verify_reserved(request, reservation)
+                await self._send_receipt_result(update.message, receipt)
+                
+            except Exception as e:
+                logger.error(f"Неудачная попытка верификации: {e}", exc_info=True)
+                await update.message.reply_text(
+                    f"❌ Ошибка: {str(e)}",
+                    parse_mode=None,
+                    reply_markup=get_main_menu_markup()
+                )
 
     @require_auth        
     async def manual_entry_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Start manual parameter entry conversation."""
-        keyboard = [['❌ Отмена и возврат в меню']]
         await update.message.reply_text(
             "📝 *Ввод параметров вручную*\n\n"
             "Шаг 1/6: Введите *номер Фискального Накопителя* (ФН)\n"
             "Пример: `7384440900730779`\n\n"
             "Введите /cancel для отмены.",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-            parse_mode='Markdown'
+            reply_markup=CANCEL_MARKUP
         )
-        return ASKING_FN
+        context.user_data['_step'] = 0
+        return ASKING_PARAM
         
-    async def ask_fn(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Store FN and ask for FD."""
+    async def ask_param(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """Validate and store the current manual entry step, then ask for the next one."""
         text = update.message.text.strip()
 
         # Check for cancel button
-        if text == '❌ Отмена и возврат в меню':
+        if text == CANCEL_BUTTON:
             return await self.cancel(update, context)
-        
-        if not text.isdigit():
-            await update.message.reply_text("❌ ФН должен быть циферным. Попробуйте снова:")
-            return ASKING_FN
-            
-        context.user_data['fn'] = text
-        keyboard = [['❌ Отмена и возврат в меню']]
-        await update.message.reply_text(
-            "✅ ФН сохранен\n\n"
-            "Шаг 2/6: Введите *номер Фискального Документа* (ФД)\n"
-            "Пример: `1145`",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-            parse_mode='Markdown'
-        )
-        return ASKING_FD
-        
-    async def ask_fd(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Store FD and ask for FP."""
-        text = update.message.text.strip()
 
-        # Check for cancel button
-        if text == '❌ Отмена и возврат в меню':
-            return await self.cancel(update, context)
-        
-        if not text.isdigit():
-            await update.message.reply_text("❌ ФД должен быть циферным. Попробуйте снова:")
-            return ASKING_FD
-            
-        context.user_data['fd'] = text
-        keyboard = [['❌ Отмена и возврат в меню']]
-        await update.message.reply_text(
-            "✅ ФД сохранен\n\n"
-            "Шаг 3/6: Введите *Фискальный признак документа* (ФП)\n"
-            "Пример: `3909409245`",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-            parse_mode='Markdown'
-        )
-        return ASKING_FP
-        
-    async def ask_fp(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Store FP and ask for datetime."""
-        text = update.message.text.strip()
-        
-        if text == '❌ Отмена и возврат в меню':
-            return await self.cancel(update, context)
-        
-        if not text.isdigit():
-            await update.message.reply_text("❌ ФП должен быть циферным. Попробуйте снова:")
-            return ASKING_FP
-            
-        context.user_data['fp'] = text
-        keyboard = [['❌ Отмена и возврат в меню']]
-        await update.message.reply_text(
-            "✅ ФП сохранен\n\n"
-            "Шаг 4/6: Введите *Дату и время*\n"
-            "Формат: `ГГГГММДДТЧЧмм`\n"
-            "Пример: `20250101T1212`",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True),
-            parse_mode='Markdown'
-        )
-        return ASKING_T
-        
-    async def ask_t(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Store datetime and ask for operation type."""
-        text = update.message.text.strip()
-        
-        if text == '❌ Отмена и возврат в меню':
-            return await self.cancel(update, context)
-        
-        if len(text) != 13 or 'T' not in text:
-            await update.message.reply_text(
-                "❌ Неправильный формат. Используйте ГГГГММДДТЧЧмм\n"
-                "Пример: `20250101T1212`",
-                parse_mode='Markdown'
-            )
-            return ASKING_T
-            
-        context.user_data['t'] = text
-        keyboard = [['❌ Отмена и возврат в меню']]
-        await update.message.reply_text(
-            "✅ Дата и время сохранены\n\n"
-            "Шаг 5/6: Введите *Вид чека* (n)\n"
-            "• 1 - Приход\n"
-            "• 2 - Возврат прихода\n"
-            "• 3 - Расход\n"
-            "• 4 - Возврат расхода",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        )
-        return ASKING_N
-        
-    async def ask_n(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Store operation type and ask for sum."""
-        text = update.message.text.strip()
-        
-        if text == '❌ Отмена и возврат в меню':
-            return await self.cancel(update, context)
-        
-        if text not in ['1', '2', '3', '4']:
-            await update.message.reply_text("❌ Должен быть 1, 2, 3, или 4. Попробуйте снова:")
-            return ASKING_N
-            
-        context.user_data['n'] = text
-        keyboard = [['❌ Отмена и возврат в меню']]
+        step = context.user_data.get('_step', 0)
+        key, is_valid, error_msg, next_prompt = _MANUAL_STEPS[step]
+
+        if not is_valid(text):
+            await update.message.reply_text(error_msg)
+            return ASKING_PARAM
+
+        context.user_data[key] = text
+        if next_prompt is None:
+            return await self._finish_manual_entry(update, context)
+
+        context.user_data['_step'] = step + 1
         await update.message.reply_text(
-            "✅ Вид чека сохранен\n\n"
-            "Шаг 6/6: Введите *Итог* в рублях\n"
-            "Пример: `1000.00` or `1000`",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            next_prompt,
+            reply_markup=CANCEL_MARKUP
         )
-        return ASKING_S
-        
-    async def ask_s(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Final step: collect sum, check for existing file, verify if needed."""
-        text = update.message.text.strip()
-        
-        if text == '❌ Отмена и возврат в меню':
-            return await self.cancel(update, context)
-        
-        try:
-            float(text)
-        except ValueError:
-            await update.message.reply_text("❌ Итог должен быть в цифрах. Попробуйте снова:")
-            return ASKING_S
-            
-        context.user_data['s'] = text
+        return ASKING_PARAM
         
+    async def _finish_manual_entry(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """Final step: check for existing file, verify if needed."""
         # Build params for file lookup
         params = {
             'fn': context.user_data['fn'],
@@ -647,81 +893,87 @@ class ReceiptBot:
         if existing_file:
             # Found existing receipt - offer choices
             filename = os.path.basename(existing_file)
-            download_data = f"download_{filename}"
-            
-            # Check if filename is too long for callback_data
-            download_data = f"download_{filename}"
-            if len(download_data.encode('utf-8')) > 64:
-                file_hash = hashlib.md5(filename.encode()).hexdigest()[:8]
-                self.qr_cache[file_hash] = filename
-                download_data = f"download_{file_hash}"
+            download_data = self._download_callback_data(filename)
             
-            manual_params = f"{params['fn']}_{params['fd']}_{params['fp']}_{context.user_data['t']}_{context.user_data['n']}_{text}"
-            keyboard = [
-                [InlineKeyboardButton("📥 Загрузить сохраненный", callback_data=download_data)],
-                [InlineKeyboardButton("🔄 Повторный запрос", callback_data=f"reverify_manual_{manual_params}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            manual_params = f"{params['fn']}_{params['fd']}_{params['fp']}_{context.user_data['t']}_{context.user_data['n']}_{context.user_data['s']}"
+            reply_markup = _saved_receipt_markup(download_data, f"reverify_manual_{manual_params}")
             
             await update.message.reply_text(
                 f"✅ *Чек уже сохранен*\n\n"
                 f"Файл: `{os.path.basename(existing_file)}`\n\n"
                 f"Выберите действие:",
-                parse_mode='Markdown',
                 reply_markup=reply_markup
             )
             context.user_data.clear()
             return ConversationHandler.END
         
-        # Check rate limit before API call
-        if not self.rate_limiter.can_make_request():
-            remaining = self.rate_limiter.get_remaining()
-            await update.message.reply_text(
-                f"⚠️ *Дневной лимит запросов достигнут*\n\n"
-                f"Не более {MAX_DAILY_REQUESTS} запросовв день.\n"
-                f"Осталось сегодня: {remaining}\n\n"
-                f"Попробуйте завтра или загрузите имеющиеся чеки.",
-                parse_mode='Markdown',
-                reply_markup=get_main_menu_markup()
-            )
+        # Reserve a request slot before any await
+        reservation = self.rate_limiter.try_acquire()
+        if reservation is None:
+            await self._reply_limit_reached(update.message)
             context.user_data.clear()
             return ConversationHandler.END
         
-        # No existing file and under limit - proceed with API verification
-        await update.message.reply_text("🔄 Отправляется запрос через API...")
-        await update.message.chat.send_action('typing')
-
-        try:
-            params_dict = {
-                'fn': context.user_data['fn'],
-                'fd': context.user_data['fd'],
-                'fp': context.user_data['fp'],
-                't': context.user_data['t'],
-                'n': context.user_data['n'],
-                's': context.user_data['s'],
-                'qr': '0'
-            }
-            
-            params_obj = RequestBuilder.from_manual_params(params_dict)
-            
-            receipt = await asyncio.to_thread(self.verifier.verify_receipt, params_obj)
-            
-            # Only increment counter if API call was successful
-            if receipt.is_valid:
-                self.rate_limiter.increment()
-                
-            await self._send_receipt_result(update, receipt)
-            
-        except Exception as e:
-            logger.error(f"Запрос параметров вручную не произведен: {e}", exc_info=True)
-            await update.message.reply_text(
-                f"❌ Ошибка: {str(e)}",
-                reply_markup=get_main_menu_markup()
-            )
-            
+        # No existing file and under limit - end the conversation now and verify in
+        # background: conversation steps block the update queue for every user
+        params_dict = {
+            'fn': context.user_data['fn'],
+            'fd': context.user_data['fd'],
+            'fp': context.user_data['fp'],
+            't': context.user_data['t'],
+            'n': context.user_data['n'],
+            's': context.user_data['s'],
+            'qr': '0'
+        }
         context.user_data.clear()
+        context.application.create_task(
+            self._verify_manual_entry(update.message, params_dict, reservation), update=update
+        )
         return ConversationHandler.END
         
+    async def _verify_manual_entry(
+            self, message: Message, params_dict: Dict[str, str], reservation: RateLimitReservation
+    ) -> None:
+        """Run API verification for manually entered parameters and reply with the result."""
+        with reservation:
+            try:
+                await asyncio.gather(
+                    message.reply_text("🔄 Отправляется запрос через API..."),
+                    message.chat.send_action('typing')
+                )
+                
+                params_obj = RequestBuilder.from_manual_params(params_dict)
+                
+                receipt = await self._verify_reserved(params_obj, reservation)
+                await self._send_receipt_result(message, receipt)
+                
+            except Exception as e:
+                logger.error(f"Запрос параметров вручную не произведен: {e}", exc_info=True)
+                await message.reply_text(
+                    f"❌ Ошибка: {str(e)}",
+                    parse_mode=None,
+                    reply_markup=get_main_menu_markup()
+                )
+                
+    async def _verify_reserved(
+            self, request: Dict[str, str], reservation: RateLimitReservation, use_cache: bool = True
+    ) -> Receipt:
+        """Call the API on a reserved slot; only a verified receipt counts against the daily limit."""
+        receipt = await self.verifier.verify_receipt_async(request, session=self._http, use_cache=use_cache)
+        if receipt.is_valid:
+            reservation.keep()
+        return receipt
+        
+    async def _reply_limit_reached(self, message: Message) -> None:
+        """Tell the user today's API request limit is used up."""
+        await message.reply_text(
+            f"⚠️ *Дневной лимит запросов достигнут*\n\n"
+            f"Не более {MAX_DAILY_REQUESTS} запросовв день.\n"
+            f"Осталось сегодня: {self.rate_limiter.get_remaining()}\n\n"
+            f"Попробуйте завтра или загрузите имеющиеся чеки.",
+            reply_markup=get_main_menu_markup()
+        )
+        
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Cancel operation and return to main menu."""
         context.user_data.clear()
@@ -731,33 +983,47 @@ class ReceiptBot:
         )
         return ConversationHandler.END
         
-    async def _send_receipt_result(self, update: Update, receipt: Receipt) -> None:
+    async def _send_receipt_result(self, message: Message, receipt: Receipt, edit: bool = False) -> None:
         """
         Format and send receipt result with auto-save to disk.
         Generates CSV with format: YYYY-MM-DD_HH-MM-SS_fn_fd_fp.csv
+        
+        With edit=True a successful result replaces the message itself
+        (used for re-verification from an inline button).
         """
         if not receipt.is_valid:
-            await update.message.reply_text(
+            await message.reply_text(
                 f"❌ *Верефикация не прошла*\n\n"
                 f"Ошибка: {receipt.error_message}",
-                parse_mode='Markdown',
                 reply_markup=get_main_menu_markup()
             )
             return
         
-        # Save CSV to disk immediately
-        csv_filename = receipt.to_csv(receipts_dir=self.receipts_dir)
+        # Save CSV to disk off the event loop
+        csv_filename, mtime_before, mtime_after = await asyncio.get_running_loop().run_in_executor(
+            self._io_pool, self._save_csv, receipt
+        )
         
         if not csv_filename:
             logger.error("Неудалось сохранить CSV файл")
-            await update.message.reply_text(
+            await message.reply_text(
                 "❌ Неудалось сохранить данные чека",
                 reply_markup=get_main_menu_markup()
             )
             return
+
+        # Register new file in the receipt index
+        self._known_files.add(os.path.basename(csv_filename))
+        key = self._receipt_key(os.path.basename(csv_filename))
+        if key:
+            self._receipt_index[key] = csv_filename
+        # Our own write changed the directory; don't treat it as an external change,
+        # unless something else changed it since the last scan (then the next lookup rescans)
+        if mtime_before == self._index_mtime_ns:
+            self._index_mtime_ns = mtime_after
             
         # Format receipt info
-        result_msg = (
+        parts = [
             f"✅ *Чек проверен*\n\n"
             f"🏪 {receipt.organization}\n"
             f"📍 {receipt.address}\n"
@@ -766,35 +1032,43 @@ class ReceiptBot:
             f"💰 Итого: *{receipt.total_sum:.2f} ₽*\n"
             f"💵 Наличные: {receipt.cash_sum:.2f} ₽\n"
             f"💳 Картой: {receipt.card_sum:.2f} ₽\n\n"
-        )
+        ]
         
         # Add items (limit to 10)
         if receipt.items:
-            result_msg += "*Покупки:*\n"
-            for i, item in enumerate(receipt.items[:10], 1):
-                result_msg += f"{i}. {item.name} - {item.price:.2f} ₽ × {item.quantity}\n"
+            parts.append("*Покупки:*\n")
+            parts.extend(
+                f"{i}. {item.name} - {item.price:.2f} ₽ × {item.quantity}\n"
+                for i, item in enumerate(receipt.items[:10], 1)
+            )
             if len(receipt.items) > 10:
-                result_msg += f"... и еще {len(receipt.items) - 10} покупок\n"
+                parts.append(f"... и еще {len(receipt.items) - 10} покупок\n")
         
-        result_msg += f"\n📁 Сохранено: `{os.path.basename(csv_filename)}`"
+        parts.append(f"\n📁 Сохранено: `{os.path.basename(csv_filename)}`")
+        result_msg = "".join(parts)
                 
         # Add download button (use only filename to avoid 64-byte callback_data limit)
-        download_data = f"download_{os.path.basename(csv_filename)}"
-        logger.info(f"New receipt download callback_data length: {len(download_data.encode('utf-8'))} bytes: {download_data}")
+        download_data = self._download_callback_data(os.path.basename(csv_filename))
         
-        if len(download_data.encode('utf-8')) > 64:
-            file_hash = hashlib.md5(os.path.basename(csv_filename).encode()).hexdigest()[:8]
-            self.qr_cache[file_hash] = os.path.basename(csv_filename)
-            download_data = f"download_{file_hash}"
-            logger.info(f"Using hash instead: {download_data}")
+        reply_markup = _download_markup(download_data)
         
-        keyboard = [[InlineKeyboardButton("📥 Загрузить CSV", callback_data=download_data)]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if edit:
+            await message.edit_text(result_msg, reply_markup=reply_markup)
+        else:
+            await message.reply_text(
+                result_msg,
+                reply_markup=reply_markup
+            )
         
-        await update.message.reply_text(
-            result_msg,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
+    async def _reply_file_missing(self, query: CallbackQuery) -> None:
+        """Tell the user a requested CSV is gone and bring back the menu."""
+        await query.edit_message_text(
+            "❌ Файл не найден. Возможно он был удален.",
+            reply_markup=None
+        )
+        await query.message.reply_text(
+            "Используйте меню ниже:",
+            reply_markup=get_main_menu_markup()
         )
         
     async def handle_csv_download(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -803,156 +1077,182 @@ class ReceiptBot:
         await query.answer()
         
         # Extract identifier from callback data
-        identifier = query.data.replace('download_', '', 1)
+        identifier = parse_download_callback(query.data)
 
         # Check if it's a hash (8 chars) or filename
-        if len(identifier) == 8 and identifier in self.qr_cache:
-            filename = self.qr_cache[identifier]
-        else:
-            filename = identifier
+        filename = (is_short_hash(identifier) and await self._recall(identifier)) or identifier
+
+        # Only serve names seen in the receipts directory (rescan if it changed)
+        if filename not in self._known_files:
+            self._refresh_index()
+            if filename not in self._known_files:
+                await self._reply_file_missing(query)
+                return
 
         csv_path = os.path.join(self.receipts_dir, filename)
         
-        if not os.path.exists(csv_path):
-            await query.edit_message_text(
-                "❌ Файл не найден. Возможно он был удален.",
-                reply_markup=None
+        try:
+            # Read off the event loop; a missing file surfaces as FileNotFoundError (no separate stat)
+            csv_bytes = await asyncio.get_running_loop().run_in_executor(
+                self._io_pool, Path(csv_path).read_bytes
             )
+        except FileNotFoundError:
+            self._forget_receipt(filename)
+            await self._reply_file_missing(query)
+            return
+        except OSError as e:
+            logger.error(f"Загрузка CSV неудачна: {e}", exc_info=True)
             await query.message.reply_text(
-                "Используйте меню ниже:",
+                f"❌ Ошибка загрузки: {str(e)}",
+                parse_mode=None,
                 reply_markup=get_main_menu_markup()
             )
             return
             
         try:
-            with open(csv_path, 'rb') as csv_file:
-                await query.message.reply_document(
-                    document=csv_file,
+            # Send file and remove the download button concurrently;
+            # if the upload fails, put the button back so the user can retry
+            download_markup = query.message.reply_markup
+            sent, _ = await asyncio.gather(
+                query.message.reply_document(
+                    document=csv_bytes,
                     filename=filename,
                     caption="📊 данные Чека"
-                )
-            
-            # Remove download button after successful download
-            await query.edit_message_reply_markup(reply_markup=None)
+                ),
+                query.edit_message_reply_markup(reply_markup=None),
+                return_exceptions=True
+            )
+            if isinstance(sent, Exception):
+                await query.edit_message_reply_markup(reply_markup=download_markup)
+                raise sent
                 
         except Exception as e:
             logger.error(f"Загрузка CSV неудачна: {e}", exc_info=True)
             await query.message.reply_text(
                 f"❌ Ошибка загрузки: {str(e)}",
+                parse_mode=None,
                 reply_markup=get_main_menu_markup()
             )
             
     async def handle_reverify(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Handle re-verification request."""
+        """Handle re-verification request: ack the callback at once, verify in background."""
         query = update.callback_query
-        await query.answer()
         
-        # Check rate limit first
-        if not self.rate_limiter.can_make_request():
-            remaining = self.rate_limiter.get_remaining()
-            await query.message.reply_text(
-                f"⚠️ *Дневной лимит запросов достигнут*\n\n"
-                f"Не более {MAX_DAILY_REQUESTS} запросов в день.\n"
-                f"Осталось сегодня: {remaining}\n\n"
-                f"Попробуйте завтра или загрузите имеющиеся чеки.",
-                parse_mode='Markdown',
-                reply_markup=get_main_menu_markup()
+        # Reserve a request slot first - reject with an alert before any other work
+        reservation = self.rate_limiter.try_acquire()
+        if reservation is None:
+            await query.answer(
+                text=f"⚠️ Дневной лимит запросов достигнут ({MAX_DAILY_REQUESTS} в день). Попробуйте завтра.",
+                show_alert=True
             )
             return
+            
+        await query.answer(text="🔄 Перепроверка…", show_alert=False, cache_time=1)
+        context.application.create_task(self._do_reverify(query, reservation), update=update)
         
+    async def _do_reverify(self, query: CallbackQuery, reservation: RateLimitReservation) -> None:
+        """Run re-verification for a callback query and reply with the result."""
         callback_data = query.data
         
-        try:
-            if callback_data.startswith('reverify_manual_'):
-                # Manual entry re-verification
-                parts = callback_data.replace('reverify_manual_', '').split('_')
-                fn, fd, fp, t, n, s = parts[0], parts[1], parts[2], parts[3], parts[4], parts[5]
-                
-                await query.message.reply_text("🔄 Перепроверка через API...")
-                
-                params_dict = {
-                    'fn': fn,
-                    'fd': fd,
-                    'fp': fp,
-                    't': t,
-                    'n': n,
-                    's': s,
-                    'qr': '0'
-                }
-                params = RequestBuilder.from_manual_params(params_dict)
-                receipt = await asyncio.to_thread(self.verifier.verify_receipt, params)
-                
-                # Increment counter if successful
-                if receipt.is_valid:
-                    self.rate_limiter.increment()
-                
-                # Create mock update for _send_receipt_result
-                mock_update = Update(update_id=update.update_id, message=query.message)
-                await self._send_receipt_result(mock_update, receipt)
-                
-            elif callback_data.startswith('reverify_qr_'):
-                # QR string re-verification using hash lookup
-                qr_hash = callback_data.replace('reverify_qr_', '', 1)
-                qr_string = self.qr_cache.get(qr_hash)
-                
-                if not qr_string:
-                    await query.message.reply_text(
-                        "❌ Сессия устарела. Отправьте QR строку снова.",
-                        reply_markup=get_main_menu_markup()
-                    )
-                    return
-                
-                await query.message.reply_text("🔄 Перепроверка через API...")
-                
-                request = RequestBuilder.from_qr_string(qr_string)
-                receipt = await asyncio.to_thread(self.verifier.verify_receipt, request)
-                
-                # Increment counter if successful
-                if receipt.is_valid:
-                    self.rate_limiter.increment()
-                
-                mock_update = Update(update_id=update.update_id, message=query.message)
-                await self._send_receipt_result(mock_update, receipt)
-                
-        except Exception as e:
-            logger.error(f"Перепроверка неудачна: {e}", exc_info=True)
-            await query.message.reply_text(
-                f"❌ Ошибка переproверки: {str(e)}",
-                reply_markup=get_main_menu_markup()
-            )
+        with reservation:
+            try:
+                if callback_data.startswith('reverify_manual_'):
+                    # Manual entry re-verification
+                    fields = parse_reverify_manual(callback_data)
+                    if fields is None:
+                        logger.warning(f"Malformed reverify callback_data: {callback_data}")
+                        return
+                    fn, fd, fp, t, n, s = fields
+                    
+                    params_dict = {
+                        'fn': fn,
+                        'fd': fd,
+                        'fp': fp,
+                        't': t,
+                        'n': n,
+                        's': s,
+                        'qr': '0'
+                    }
+                    params = RequestBuilder.from_manual_params(params_dict)
+                    receipt = await self._verify_reserved(params, reservation, use_cache=False)
+                    await self._send_receipt_result(query.message, receipt, edit=True)
+                    
+                elif callback_data.startswith('reverify_qr_'):
+                    # QR string re-verification using hash lookup
+                    qr_hash = parse_reverify_qr(callback_data)
+                    qr_string = await self._recall(qr_hash)
+                    
+                    if not qr_string:
+                        await query.message.reply_text(
+                            "❌ Сессия устарела. Отправьте QR строку снова.",
+                            reply_markup=get_main_menu_markup()
+                        )
+                        return
+                    
+                    request = RequestBuilder.from_qr_string(qr_string)
+                    receipt = await self._verify_reserved(request, reservation, use_cache=False)
+                    await self._send_receipt_result(query.message, receipt, edit=True)
+                    
+            except Exception as e:
+                logger.error(f"Перепроверка неудачна: {e}", exc_info=True)
+                await query.message.reply_text(
+                    f"❌ Ошибка переproверки: {str(e)}",
+                    parse_mode=None,
+                    reply_markup=get_main_menu_markup()
+                )
             
+    async def _prompt_qr(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Explain the expected QR string format."""
+        await update.message.reply_text(
+            "📱 Отправьте QR строку в формате:\n"
+            "`t=...&s=...&fn=...&i=...&fp=...&n=1`",
+            reply_markup=get_main_menu_markup()
+        )
+        
     async def handle_button_press(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Route keyboard button presses."""
-        text = update.message.text
-        
-        if text == '📱 Распознать из QR строки':
-            await update.message.reply_text(
-                "📱 Отправьте QR строку в формате:\n"
-                "`t=...&s=...&fn=...&i=...&fp=...&n=1`",
-                parse_mode='Markdown',
-                reply_markup=get_main_menu_markup()
+        handler = self._button_handlers.get(update.message.text)
+        if handler:
+            await handler(update, context)
+            
+    async def _post_init(self, app: Application) -> None:
+        """Open the shared HTTP session once the bot's event loop is running."""
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                ttl_dns_cache=HTTP_DNS_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE
             )
-        elif text == '📊 Статистика':
-            await self.stats_command(update, context)
-        elif text == '❓ Help':
-            await self.help_command(update, context)
+        )
+        
+    async def _post_shutdown(self, app: Application) -> None:
+        """Close pooled HTTP connections."""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        await self.verifier.aclose()
             
     def build_application(self) -> Application:
         """Build bot application with all handlers."""
-        self.app = Application.builder().token(self.telegram_token).build()
+        self.app = (
+            Application.builder()
+            .token(self.telegram_token)
+            # Handlers outside the conversation run as independent tasks; Markdown unless a call overrides it
+            .defaults(Defaults(block=False, parse_mode='Markdown'))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
         
-        # Conversation handler for manual entry
+        # Conversation handler for manual entry. Its handlers stay blocking despite the
+        # block=False default: the next step must not be read before this one's state is set.
+        # Each step is quick; the final API call is handed off to a background task
         conv_handler = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex('^⌨️ Ввод параметров вручную$'), self.manual_entry_start)],
+            entry_points=[MessageHandler(_MANUAL_ENTRY_FILTER, self.manual_entry_start, block=True)],
             states={
-                ASKING_FN: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_fn)],
-                ASKING_FD: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_fd)],
-                ASKING_FP: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_fp)],
-                ASKING_T: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_t)],
-                ASKING_N: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_n)],
-                ASKING_S: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.ask_s)],
+                ASKING_PARAM: [MessageHandler(_TEXT_FILTER, self.ask_param, block=True)],
             },
-            fallbacks=[CommandHandler('cancel', self.cancel)],
+            fallbacks=[CommandHandler('cancel', self.cancel, block=True)],
         )
         
         # Register handlers
@@ -963,8 +1263,8 @@ class ReceiptBot:
         self.app.add_handler(conv_handler)
         self.app.add_handler(CallbackQueryHandler(self.handle_csv_download, pattern='^download_'))
         self.app.add_handler(CallbackQueryHandler(self.handle_reverify, pattern='^reverify'))
-        self.app.add_handler(MessageHandler(filters.Regex('^(📱|📊|❓)'), self.handle_button_press))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_qr_string))
+        self.app.add_handler(MessageHandler(_MENU_BUTTON_FILTER, self.handle_button_press))
+        self.app.add_handler(MessageHandler(_TEXT_FILTER, self.handle_qr_string))
         
         return self.app
         
@@ -972,12 +1272,24 @@ class ReceiptBot:
         """Start bot with polling mode."""
         app = self.build_application()
         logger.info("🤖 Bot starting...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
+        finally:
+            self._io_pool.shutdown(wait=True)
+            self._qr_store.close()
+            self.rate_limiter.close()
 
-def load_config(config_file: str = "config.json") -> Dict[str, str]:
+# Keys that must be present in config.json
+_REQUIRED_CONFIG = ('TELEGRAM_BOT_TOKEN', 'RECEIPT_API_TOKEN')
+
+@lru_cache(maxsize=2)
+def load_config(config_file: str = "config.json") -> Mapping[str, str]:
     """
     Load configuration from JSON file.
     
+    Parsed once per path and cached; the returned mapping is read-only
+    so callers can't alter what later calls see.
+    
     Expected format:
     {
         "TELEGRAM_BOT_TOKEN": "123456:ABC-DEF...",
@@ -988,32 +1300,30 @@ def load_config(config_file: str = "config.json") -> Dict[str, str]:
         config_file: Path to configuration JSON file
         
     Returns:
-        Dictionary with token values
+        Read-only mapping with token values
         
     Raises:
         FileNotFoundError: If config file doesn't exist
         KeyError: If required tokens missing from config
     """
-    if not os.path.exists(config_file):
+    try:
+        with open(config_file, 'rb') as f:
+            config = json_loads(f.read())
+    except FileNotFoundError:
         raise FileNotFoundError(
             f"Configuration file '{config_file}' not found. "
             f"Create it with TELEGRAM_BOT_TOKEN and RECEIPT_API_TOKEN."
-        )
-    
-    try:
-        with open(config_file, 'r') as f:
-            config = json.load(f)
+        ) from None
     except json.JSONDecodeError as e:
         raise ValueError(f"Invalid JSON in config file: {e}")
     
     # Validate required fields
-    required = ['TELEGRAM_BOT_TOKEN', 'RECEIPT_API_TOKEN']
-    missing = [key for key in required if key not in config]
+    missing = [key for key in _REQUIRED_CONFIG if key not in config]
     
     if missing:
         raise KeyError(f"Missing required configuration: {', '.join(missing)}")
     
-    return config
+    return MappingProxyType(config)
 
 def main():
     """Entry point with JSON configuration file."""
@@ -1038,6 +1348,10 @@ def main():
         logger.error("Or set environment variables")
         return
         
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop")
+        
     bot = ReceiptBot(telegram_token, receipt_token)
     bot.run()
 